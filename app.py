@@ -1,11 +1,20 @@
 import streamlit as st
 import boto3
-import yt_dlp
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import os
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import random
+import functools
+import re
+
+from downloader import close_ydl_workers, download_song, init_ydl_worker
+from models import Song
 
 
 '''
@@ -23,12 +32,22 @@ st.set_page_config(
     layout="wide"
 )
 
+# ============================================
+# SECRETS
+# ============================================
+@functools.lru_cache(maxsize=None)
+def get_secret(key, default=None):
+    """Lee un secret una sola vez por proceso (usar get_secret.cache_clear() para recargar)"""
+    if default is None:
+        return st.secrets[key]
+    return st.secrets.get(key, default)
+
 # ============================================
 # CONTROL DE ACCESO FÁCIL
 # ============================================
 def check_access():
     """Verifica acceso con código persistente en sesión"""
-    SECRET_CODE = st.secrets.get("ACCESS_CODE", "mi_codigo_secreto_123")
+    SECRET_CODE = get_secret("ACCESS_CODE", "mi_codigo_secreto_123")
     
     # Si ya está autenticado en esta sesión
     if st.session_state.get("authenticated", False):
@@ -62,105 +81,156 @@ check_access()
 # ============================================
 # FUNCIONES DE BACKBLAZE B2
 # ============================================
+@st.cache_resource
 def get_b2_client():
-    """Crea cliente de Backblaze B2"""
+    """Crea cliente de Backblaze B2 (reutilizado entre reruns)"""
     return boto3.client(
         's3',
-        endpoint_url=st.secrets["B2_ENDPOINT"],
-        aws_access_key_id=st.secrets["B2_KEY_ID"],
-        aws_secret_access_key=st.secrets["B2_APP_KEY"]
+        endpoint_url=get_secret("B2_ENDPOINT"),
+        aws_access_key_id=get_secret("B2_KEY_ID"),
+        aws_secret_access_key=get_secret("B2_APP_KEY"),
+        config=Config(
+            max_pool_connections=32,
+            retries={'max_attempts': 3, 'mode': 'standard'}
+        )
     )
 
+@st.cache_data
+def _bucket():
+    """Nombre del bucket de B2"""
+    return get_secret("B2_BUCKET")
+
+@st.cache_data(ttl=60, show_spinner=False)
 def list_playlists():
     """Lista todas las carpetas (playlists) en el bucket"""
     b2 = get_b2_client()
-    bucket = st.secrets["B2_BUCKET"]
+    bucket = _bucket()
     
-    response = b2.list_objects_v2(Bucket=bucket, Delimiter='/')
+    paginator = b2.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=bucket,
+        Delimiter='/',
+        PaginationConfig={'PageSize': 1000}
+    )
     playlists = []
     
-    for prefix in response.get('CommonPrefixes', []):
-        folder_name = prefix['Prefix'].rstrip('/')
-        playlists.append(folder_name)
+    for page in pages:
+        for prefix in page.get('CommonPrefixes', []):
+            folder_name = prefix['Prefix'].rstrip('/')
+            playlists.append(folder_name)
     
     return playlists
 
+@st.cache_data(ttl=60, show_spinner=False)
 def list_songs_in_playlist(playlist_name):
     """Lista todas las canciones en una playlist"""
     b2 = get_b2_client()
-    bucket = st.secrets["B2_BUCKET"]
+    bucket = _bucket()
     
-    response = b2.list_objects_v2(Bucket=bucket, Prefix=f"{playlist_name}/")
+    paginator = b2.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=bucket,
+        Prefix=f"{playlist_name}/",
+        PaginationConfig={'PageSize': 1000}
+    )
     songs = []
     
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        if key.endswith('.mp3'):
-            song_name = key.split('/')[-1]
-            songs.append({'key': key, 'name': song_name})
+    for page in pages:
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if key.endswith('.mp3'):
+                song_name = key.split('/')[-1]
+                songs.append(Song(key=key, name=song_name, display=song_name[:-4]))
     
-    return songs
+    return tuple(songs)
 
-def get_song_data(key):
-    """Descarga la canción y devuelve los bytes"""
+@st.cache_data(ttl=1800, show_spinner=False)
+def get_song_url(key):
+    """Genera una URL firmada para que el navegador reproduzca la canción desde B2"""
     b2 = get_b2_client()
-    bucket = st.secrets["B2_BUCKET"]
+    bucket = _bucket()
     
-    response = b2.get_object(Bucket=bucket, Key=key)
-    return response['Body'].read()
+    # Caduca en 1h; la caché (30 min) garantiza que nunca se sirve una URL caducada
+    return b2.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=3600
+    )
+
+# Multipart en paralelo para MP3 grandes (> 8 MB)
+UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True
+)
 
 def upload_song_to_b2(file_path, playlist_name):
     """Sube una canción a B2"""
     b2 = get_b2_client()
-    bucket = st.secrets["B2_BUCKET"]
+    bucket = _bucket()
     filename = os.path.basename(file_path)
     key = f"{playlist_name}/{filename}"
     
-    b2.upload_file(file_path, bucket, key)
+    b2.upload_file(file_path, bucket, key, Config=UPLOAD_CONFIG)
     return key
 
 # ============================================
 # FUNCIONES DE SPOTIFY API
 # ============================================
-def get_spotify_access_token():
-    """Obtiene token de acceso para la API de Spotify"""
-    client_id = st.secrets["SPOTIFY_CLIENT_ID"]
-    client_secret = st.secrets["SPOTIFY_CLIENT_SECRET"]
+@st.cache_resource
+def get_spotify_session():
+    """Sesión HTTP con keep-alive compartida para las llamadas a Spotify"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('https://', adapter)
+    return session
+
+@functools.lru_cache(maxsize=1)
+def get_spotify_basic_auth():
+    """Credenciales de Spotify codificadas en base64 (se calculan una vez por proceso)"""
+    client_id = get_secret("SPOTIFY_CLIENT_ID")
+    client_secret = get_secret("SPOTIFY_CLIENT_SECRET")
     
     credentials = f"{client_id}:{client_secret}"
-    encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
-    
+    return base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+
+@st.cache_data(ttl=3300, show_spinner=False)
+def get_spotify_access_token():
+    """Obtiene token de acceso para la API de Spotify (válido ~1h, se reutiliza)"""
     headers = {
-        'Authorization': f'Basic {encoded_credentials}',
+        'Authorization': f'Basic {get_spotify_basic_auth()}',
         'Content-Type': 'application/x-www-form-urlencoded'
     }
     data = {'grant_type': 'client_credentials'}
     
-    response = requests.post('https://accounts.spotify.com/api/token', headers=headers, data=data)
+    response = get_spotify_session().post('https://accounts.spotify.com/api/token', headers=headers, data=data)
     response.raise_for_status()
     return response.json()['access_token']
 
-def extract_playlist_id(playlist_url):
-    """Extrae el ID de la playlist de una URL de Spotify"""
-    playlist_url = playlist_url.strip().split('?')[0]
-    parts = playlist_url.split('/')
-    for part in parts:
-        if len(part) == 22:
-            return part
-    raise ValueError("No se pudo extraer el ID de la playlist")
-
-def get_playlist_tracks(playlist_url):
-    """Extrae todas las canciones de una playlist de Spotify"""
+PLAYLIST_ID_RE = re.compile(r'^https?://open\.spotify\.com/(?:[\w-]+/)?playlist/([A-Za-z0-9]{22})(?![A-Za-z0-9])')
+
+def get_playlist_tracks_by_id(playlist_id):
+    """Extrae todas las canciones de una playlist de Spotify a partir de su ID"""
     access_token = get_spotify_access_token()
-    playlist_id = extract_playlist_id(playlist_url)
     
+    session = get_spotify_session()
     headers = {'Authorization': f'Bearer {access_token}'}
-    url = f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+    # Solo pedimos los campos que usamos; el enlace 'next' conserva el filtro
+    url = (
+        f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+        '?limit=100&fields=next,items(track(name,artists(name)))'
+    )
     
     all_tracks = []
     
     while url:
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
+        if response.status_code == 401:
+            # Token caducado: pedir uno nuevo y reintentar una vez
+            get_spotify_access_token.clear()
+            headers = {'Authorization': f'Bearer {get_spotify_access_token()}'}
+            response = session.get(url, headers=headers)
         response.raise_for_status()
         data = response.json()
         
@@ -179,32 +249,46 @@ def get_playlist_tracks(playlist_url):
 # ============================================
 # FUNCIÓN DE DESCARGA CON YT-DLP
 # ============================================
-def download_song(song_name, output_path, quality=192):
-    """Descarga canción de YouTube como MP3"""
-    search_query = f"ytsearch1:{song_name} lyrics" # Pongo "lyrics" para que busque la canción tal cual, no video clip ni eso
+INVALID_FILENAME_CHARS_RE = re.compile(r'[\\/:*?"<>|]')
+
+# NAME_MAX suele ser 255 bytes; se deja margen para la extensión
+MAX_FILENAME_STEM_BYTES = 200
+
+def song_filename(song_name):
+    """Nombre de archivo predecible para una canción ("Título - Artistas.mp3")"""
+    stem = INVALID_FILENAME_CHARS_RE.sub('_', song_name).strip()
+    # Recortar por bytes sin partir caracteres multibyte
+    stem = stem.encode('utf-8')[:MAX_FILENAME_STEM_BYTES].decode('utf-8', 'ignore').strip()
+    return stem + '.mp3'
+
+def fetch_song(song_name, playlist_name, work_dir, existing=frozenset()):
+    """Descarga una canción en su subcarpeta de work_dir y la sube a B2.
     
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'no_warnings': True,
-        'ignoreerrors': True,
-        'nooverwrites': True,
-        'no_color': True,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': str(quality),
-        }],
-        'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
-    }
+    Devuelve False si la canción ya estaba en la playlist (`existing`) y se omitió.
+    Lanza RuntimeError si yt-dlp no produjo ningún MP3 (con 'ignoreerrors' no falla solo).
+    """
+    filename = song_filename(song_name)
+    if filename in existing:
+        return False
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([search_query])
+    # Subcarpeta propia para evitar colisiones de nombres entre hilos
+    song_dir = tempfile.mkdtemp(dir=work_dir)
+    downloaded = download_song(song_name, song_dir)
+    if not downloaded or not os.path.exists(downloaded):
+        raise RuntimeError(f"No se pudo descargar '{song_name}'")
     
-    for f in os.listdir(output_path):
-        if f.endswith('.mp3'):
-            return os.path.join(output_path, f)
-    return None
+    try:
+        # Playlists antiguas guardaban el título de YouTube: no duplicar esas canciones
+        if os.path.basename(downloaded) in existing:
+            return False
+        target = os.path.join(song_dir, filename)
+        os.rename(downloaded, target)
+        downloaded = target
+        upload_song_to_b2(downloaded, playlist_name)
+    finally:
+        # Liberar disco ya; las carpetas se borran al final con work_dir
+        os.remove(downloaded)
+    return True
 
 # ============================================
 # FUNCIÓN DE AUTOPLAY
@@ -213,10 +297,19 @@ def inject_autoplay_script():
     """Inyecta JavaScript para reproducción automática"""
     autoplay_js = """
     <script>
-    let isProcessing = false; // Flag para evitar ejecuciones simultáneas
+    // Se instala en la página padre: el iframe de este componente desaparece
+    // en los siguientes reruns, pero los listeners tienen que seguir vivos
+    const parentWin = window.parent;
+    if (!parentWin.__autoplayInstalled) {
+        parentWin.__autoplayInstalled = true;
+        const script = parentWin.document.createElement('script');
+        script.textContent = `(${setupAutoplay.toString()})();`;
+        parentWin.document.head.appendChild(script);
+    }
     
-    setTimeout(() => {
-        const parentDoc = window.parent.document;
+    function setupAutoplay() {
+        let isProcessing = false; // Flag para evitar ejecuciones simultáneas
+        const parentDoc = document;
         
         // ==========================================
         // FUNCIÓN 1: Solo presiona el botón "Siguiente"
@@ -359,25 +452,26 @@ def inject_autoplay_script():
         }
         
         // ==========================================
-        // MUTATION OBSERVER: Detecta cambios en el DOM
+        // MUTATION OBSERVER: Detecta nuevos nodos en el DOM (sin polling)
         // ==========================================
+        let pendingSetup = null;
         const observer = new MutationObserver((mutations) => {
-            // Reconfigurar listeners si aparecen nuevos elementos
-            setTimeout(() => {
+            if (pendingSetup || !mutations.some(m => m.addedNodes.length > 0)) {
+                return;
+            }
+            // Agrupar ráfagas de cambios de Streamlit en una sola reconfiguración
+            pendingSetup = setTimeout(() => {
+                pendingSetup = null;
                 setupButtonListener();
                 setupAudioListener();
             }, 500);
         });
         
-        // Observar cambios en el contenedor principal
-        const mainContainer = parentDoc.querySelector('[data-testid="stAppViewContainer"]');
-        if (mainContainer) {
-            observer.observe(mainContainer, { 
-                childList: true, 
-                subtree: true
-            });
-            console.log('✅ Observer del DOM configurado');
-        }
+        observer.observe(parentDoc.body, { 
+            childList: true, 
+            subtree: true
+        });
+        console.log('✅ Observer del DOM configurado');
         
         // ==========================================
         // INICIALIZACIÓN
@@ -385,21 +479,18 @@ def inject_autoplay_script():
         setupButtonListener();
         setupAudioListener();
         
-        // Verificar periódicamente por si se necesita reconfigurar
-        setInterval(() => {
-            if (!isProcessing) {
-                setupButtonListener();
-                setupAudioListener();
-            }
-        }, 3000);
-        
         console.log('✅ Sistema de autoplay activado completamente');
-    }, 3000);
+    }
     </script>
     """
     st.components.v1.html(autoplay_js, height=0)
 
 
+def pick_random_song(num_songs):
+    """Elige una canción aleatoria para reproducir a continuación"""
+    st.session_state.current_index = random.randrange(num_songs)
+
+
 # ============================================
 # INTERFAZ DE STREAMLIT
 # ============================================
@@ -431,41 +522,84 @@ with tab1:
     )
     
     if st.button("🚀 Descargar Playlist", type="primary"):
+        # Valida la URL y extrae el ID de la playlist en una sola pasada
+        playlist_match = PLAYLIST_ID_RE.match(playlist_url.strip())
         if not playlist_url:
             st.error("Introduce la URL de la playlist")
         elif not folder_name.strip():
             st.error("Introduce un nombre para la carpeta")
-        elif "spotify.com/playlist" not in playlist_url:
+        elif not playlist_match:
             st.error("URL no válida. Debe ser una playlist de Spotify")
         else:
             try:
                 safe_name = "".join(c for c in folder_name if c.isalnum() or c in ' -_').strip()
                 
                 with st.spinner("Obteniendo canciones de Spotify..."):
-                    canciones = get_playlist_tracks(playlist_url)
+                    canciones = get_playlist_tracks_by_id(playlist_match.group(1))
                 
                 st.success(f"✅ {len(canciones)} canciones encontradas")
                 
                 progress_bar = st.progress(0)
                 status = st.empty()
                 
-                for i, song in enumerate(canciones):
-                    status.text(f"⬇️ ({i+1}/{len(canciones)}) {song}")
-                    
-                    with tempfile.TemporaryDirectory() as tmp_dir:
-                        downloaded = download_song(song, tmp_dir, quality)
-                        
-                        if downloaded and os.path.exists(downloaded):
-                            upload_song_to_b2(downloaded, safe_name)
-                    
-                    progress_bar.progress((i + 1) / len(canciones))
+                # Inicializar el cliente en el hilo principal; los workers lo comparten
+                get_b2_client()
+                _bucket()
+                
+                # Canciones ya subidas (p. ej. al repetir una playlist) no se vuelven a descargar
+                existing = frozenset(s.name for s in list_songs_in_playlist(safe_name))
+                skipped = 0
+                failed = []
+                
+                max_workers = max(1, min(8, len(canciones)))
+                # Se borra en close_ydl_workers, cuando ningún hilo escribe ya en él
+                work_dir = tempfile.mkdtemp()
+                ydl_instances = []
+                executor = ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=init_ydl_worker,
+                    initargs=(quality, ydl_instances)
+                )
+                try:
+                    futures = {
+                        executor.submit(fetch_song, song, safe_name, work_dir, existing): song
+                        for song in canciones
+                    }
+                    for i, future in enumerate(as_completed(futures)):
+                        # Una canción que falla no detiene el resto de la playlist
+                        try:
+                            if not future.result():
+                                skipped += 1
+                        except Exception:
+                            failed.append(futures[future])
+                        status.text(f"⬇️ ({i+1}/{len(canciones)}) {futures[future]}")
+                        progress_bar.progress((i + 1) / len(canciones))
+                except BaseException:
+                    # Incluye el rerun/stop de Streamlit: no esperar a toda la cola
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    # YoutubeDL y work_dir se liberan cuando acabe la canción en curso
+                    threading.Thread(
+                        target=close_ydl_workers,
+                        args=(executor, ydl_instances, work_dir),
+                        daemon=True
+                    ).start()
+                    raise
+                close_ydl_workers(executor, ydl_instances, work_dir)
                 
                 status.empty()
                 st.success(f"🎉 ¡Listo! Canciones guardadas en '{safe_name}'")
+                if skipped:
+                    st.info(f"⏭️ {skipped} canciones ya estaban guardadas y se omitieron")
+                if failed:
+                    st.warning(f"⚠️ {len(failed)} canciones fallaron: {', '.join(failed)}")
                 st.balloons()
                     
             except Exception as e:
                 st.error(f"Error: {str(e)}")
+            finally:
+                # También tras un fallo parcial: el siguiente intento debe ver lo ya subido
+                list_playlists.clear()
+                list_songs_in_playlist.clear()
 
 
 
@@ -477,6 +611,8 @@ with tab2:
     st.header("Mis playlists guardadas")
     
     if st.button("🔄 Refrescar"):
+        list_playlists.clear()
+        list_songs_in_playlist.clear()
         st.rerun()
     
     try:
@@ -500,19 +636,22 @@ with tab2:
                     
                     # Inicializar índice aleatorio en session_state
                     if 'current_index' not in st.session_state:
-                        st.session_state.current_index = random.randint(0, len(songs) - 1)
+                        pick_random_song(len(songs))
                     
-                    # Botón para canción aleatoria
-                    if st.button("🔀 Siguiente (Aleatoria)", type="primary"):
-                        st.session_state.current_index = random.randint(0, len(songs) - 1)
-                        st.rerun()
+                    # Botón para canción aleatoria: el callback corre antes del rerun,
+                    # así que no hace falta un segundo st.rerun()
+                    st.button(
+                        "🔀 Siguiente (Aleatoria)",
+                        type="primary",
+                        on_click=pick_random_song,
+                        args=(len(songs),)
+                    )
                     
-                    song_names = [s['name'].replace('.mp3', '') for s in songs]
                     selected_index = st.selectbox(
                         "🎵 Selecciona una canción",
                         range(len(songs)),
                         index=st.session_state.current_index,
-                        format_func=lambda i: song_names[i]
+                        format_func=lambda i: songs[i].display
                     )
                     
                     # Actualizar session_state si el usuario selecciona manualmente
@@ -520,18 +659,20 @@ with tab2:
                     
                     if selected_index is not None:
                         selected_song = songs[selected_index]
-                        st.write(f"**🎧 Reproduciendo:** {selected_song['name'].replace('.mp3', '')}")
+                        st.write(f"**🎧 Reproduciendo:** {selected_song.display}")
                         
-                        audio_data = get_song_data(selected_song['key'])
-                        st.audio(audio_data, format='audio/mp3')
+                        song_url = get_song_url(selected_song.key)
+                        st.audio(song_url, format='audio/mp3')
                         
-                        # Inyectar script de autoplay
-                        inject_autoplay_script()
+                        # Inyectar script de autoplay una sola vez por sesión
+                        if not st.session_state.get('_autoplay_injected'):
+                            inject_autoplay_script()
+                            st.session_state._autoplay_injected = True
                         
                         with st.expander("📋 Todas las canciones"):
-                            for i, name in enumerate(song_names):
+                            for i, song in enumerate(songs):
                                 prefix = "▶️ " if i == selected_index else "　"
-                                st.write(f"{prefix}{name}")
+                                st.write(f"{prefix}{song.display}")
                 else:
                     st.warning("Playlist vacía")
                     
@@ -0,0 +1,56 @@
+import shutil
+import threading
+
+import yt_dlp
+
+
+# Vive fuera de app.py para poder probarlo sin ejecutar el script de Streamlit.
+# Un YoutubeDL por hilo del pool para no pagar su inicialización en cada canción
+_ydl_local = threading.local()
+
+def _capture_final_path(filepath):
+    """post_hook de yt-dlp: recibe la ruta final, ya tras todos los postprocesadores"""
+    # No usar postprocessor_hooks: reciben una copia del info_dict con la ruta
+    # original (.webm/.m4a), que yt-dlp borra después de extraer el MP3
+    _ydl_local.final_paths.append(filepath)
+
+def init_ydl_worker(quality, instances):
+    """Initializer del pool: crea el YoutubeDL del hilo y lo registra en `instances`"""
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'ignoreerrors': True,
+        'nooverwrites': True,
+        'no_color': True,
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': str(quality),
+        }],
+        'outtmpl': '%(title)s.%(ext)s',
+        'post_hooks': [_capture_final_path],
+    }
+    _ydl_local.ydl = yt_dlp.YoutubeDL(ydl_opts)
+    instances.append(_ydl_local.ydl)
+
+def close_ydl_workers(executor, instances, work_dir):
+    """Espera a que terminen los hilos del pool, cierra sus YoutubeDL y borra work_dir"""
+    executor.shutdown(wait=True)
+    for ydl in instances:
+        ydl.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+def download_song(song_name, output_path):
+    """Descarga canción de YouTube como MP3 (desde un hilo iniciado con init_ydl_worker)"""
+    search_query = f"ytsearch1:{song_name} lyrics" # Pongo "lyrics" para que busque la canción tal cual, no video clip ni eso
+    
+    ydl = _ydl_local.ydl
+    # El directorio de salida cambia en cada canción. OJO: esto depende de que
+    # YoutubeDL lea self.params['paths'] al preparar cada nombre de archivo,
+    # lo cual no es API pública de yt-dlp
+    ydl.params['paths'] = {'home': output_path}
+    _ydl_local.final_paths = []
+    ydl.download([search_query])
+    
+    return _ydl_local.final_paths[0] if _ydl_local.final_paths else None
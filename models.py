@@ -0,0 +1,11 @@
+from dataclasses import dataclass
+
+
+# Vive fuera de app.py para que pickle (st.cache_data) tenga una ruta estable:
+# Streamlit reinstala el script como __main__ en cada rerun de cada sesión
+@dataclass(frozen=True, slots=True)
+class Song:
+    """Canción guardada en B2"""
+    key: str
+    name: str
+    display: str
@@ -0,0 +1,56 @@
+import copy
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Solo se prueba la lógica de download_song; YoutubeDL se sustituye por un stub
+sys.modules.setdefault('yt_dlp', types.ModuleType('yt_dlp'))
+
+import downloader
+
+
+class FakeYoutubeDL:
+    """Imita el flujo de yt-dlp: descarga .webm, FFmpegExtractAudio crea el .mp3
+    y borra el original; los postprocessor_hooks reciben una copia del info_dict"""
+
+    def __init__(self, params):
+        self.params = params
+
+    def download(self, queries):
+        home = self.params['paths']['home']
+        original = os.path.join(home, 'Song.webm')
+        open(original, 'wb').close()
+        info = {'filepath': original}
+
+        info_copy = copy.deepcopy(info)
+        mp3 = os.path.join(home, 'Song.mp3')
+        open(mp3, 'wb').close()
+        info['filepath'] = mp3
+        for hook in self.params.get('postprocessor_hooks', []):
+            hook({'status': 'finished', 'postprocessor': 'ExtractAudio', 'info_dict': info_copy})
+        os.remove(original)
+
+        for hook in self.params.get('post_hooks', []):
+            hook(info['filepath'])
+
+    def close(self):
+        pass
+
+
+class DownloadSongTest(unittest.TestCase):
+    def test_returns_existing_mp3(self):
+        with mock.patch.object(downloader.yt_dlp, 'YoutubeDL', FakeYoutubeDL, create=True):
+            downloader.init_ydl_worker(192, [])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = downloader.download_song('Song - Artist', tmp_dir)
+            self.assertIsNotNone(path)
+            self.assertTrue(path.endswith('.mp3'))
+            self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()